@@ -1,21 +1,25 @@
 import requests
 import numpy as np
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import queue
+import threading
 import time
 
 class BatchManager:
+    # Сколько раз батч отправляется на серверы, прежде чем считается потерянным
+    MAX_BATCH_ATTEMPTS = 3
+    # После стольких ошибок подряд сервер исключается из пула
+    MAX_CONSECUTIVE_FAILURES = 3
+    
     def __init__(self, server_urls):
         self.server_urls = server_urls
-        self.current_server = 0
         self.completed_batches = 0
         self.total_batches = 0
-    
-    def get_next_server(self):
-        """Round-robin распределение по серверам"""
-        server = self.server_urls[self.current_server]
-        self.current_server = (self.current_server + 1) % len(self.server_urls)
-        return server
+        self.servers_checked = False
+        self._lock = threading.Lock()
+        self._known_data_cache = {}
     
     def check_server_health(self, server_url):
         """Проверяет доступность сервера"""
@@ -25,7 +29,44 @@ class BatchManager:
         except:
             return False
     
-    def send_batch_to_server(self, batch_data, server_url):
+    def ensure_available_servers(self):
+        """Проверяет серверы один раз и оставляет в пуле только доступные"""
+        if self.servers_checked:
+            return self.server_urls
+        
+        print(f"🔍 Проверка доступности серверов...")
+        available_servers = []
+        for server_url in self.server_urls:
+            if self.check_server_health(server_url):
+                available_servers.append(server_url)
+                print(f"   ✓ {server_url} - доступен")
+            else:
+                print(f"   ✗ {server_url} - недоступен")
+        
+        if not available_servers:
+            print("❌ Нет доступных серверов!")
+            return []
+        
+        self.server_urls = available_servers
+        self.servers_checked = True
+        print(f"🌐 Используется {len(available_servers)} серверов")
+        return available_servers
+    
+    def serialize_known_data(self, known_data):
+        """Сериализует данные станций один раз для всех батчей, которые их разделяют"""
+        with self._lock:
+            serialized = self._known_data_cache.get(id(known_data))
+            if serialized is None:
+                serialized = {
+                    'lons': known_data['lons'].tolist(),
+                    'lats': known_data['lats'].tolist(),
+                    'max_values': known_data['max_values'].tolist(),
+                    'mean_values': known_data['mean_values'].tolist()
+                }
+                self._known_data_cache[id(known_data)] = serialized
+            return serialized
+    
+    def send_batch_to_server(self, batch_data, server_url, job_id=None):
         """Отправляет батч на сервер и получает результат"""
         try:
             # Подготовка данных для JSON сериализации
@@ -34,12 +75,7 @@ class BatchManager:
                 'end_row': batch_data['end_row'],
                 'lons_grid': batch_data['lons_grid'].tolist(),
                 'lats_grid': batch_data['lats_grid'].tolist(), 
-                'known_data': {
-                    'lons': batch_data['known_data']['lons'].tolist(),
-                    'lats': batch_data['known_data']['lats'].tolist(),
-                    'max_values': batch_data['known_data']['max_values'].tolist(),
-                    'mean_values': batch_data['known_data']['mean_values'].tolist()
-                },
+                'known_data': self.serialize_known_data(batch_data['known_data']),
                 'power': batch_data['power'],
                 'polygon_mask': batch_data.get('polygon_mask', None)
             }
@@ -58,8 +94,11 @@ class BatchManager:
             
             if response.status_code == 200:
                 result = response.json()
-                self.completed_batches += 1
-                print(f"✅ [{self.completed_batches}/{self.total_batches}] {server_url}: строки {batch_data['start_row']}-{batch_data['end_row']} ({processing_time:.1f}с)")
+                with self._lock:
+                    self.completed_batches += 1
+                    completed = self.completed_batches
+                job_label = f"{job_id}: " if job_id is not None else ""
+                print(f"✅ [{completed}/{self.total_batches}] {server_url}: {job_label}строки {batch_data['start_row']}-{batch_data['end_row']} ({processing_time:.1f}с)")
                 
                 # Конвертируем результат обратно в numpy
                 results_array = np.array(result['results'], dtype=np.float32)
@@ -80,44 +119,132 @@ class BatchManager:
     
     def distribute_batches(self, batches_data, max_workers=None):
         """Распределяет батчи по серверам и собирает результаты"""
-        self.total_batches = len(batches_data)
-        self.completed_batches = 0
+        job = {'job_id': None, 'batches': batches_data}
+        return self.distribute_jobs([job], max_workers=max_workers).get(None, {})
+    
+    def distribute_jobs(self, jobs, max_workers=None, on_job_complete=None):
+        """
+        Распределяет батчи нескольких заданий через общий пул серверов.
         
-        print(f"🔍 Проверка доступности серверов...")
-        available_servers = []
-        for server_url in self.server_urls:
-            if self.check_server_health(server_url):
-                available_servers.append(server_url)
-                print(f"   ✓ {server_url} - доступен")
-            else:
-                print(f"   ✗ {server_url} - недоступен")
+        Каждое задание - словарь с ключами 'job_id', 'batches' и необязательным
+        'priority' (больше - раньше). Батчи заданий с одинаковым приоритетом
+        чередуются. max_workers - число одновременных запросов (по умолчанию
+        по одному на сервер); каждый поток берет следующий батч из общей очереди
+        и отправляет его на наименее загруженный сервер, поэтому быстрые серверы
+        получают больше батчей.
+        
+        Неудачный батч возвращается в очередь до MAX_BATCH_ATTEMPTS попыток, а
+        сервер после MAX_CONSECUTIVE_FAILURES ошибок подряд исключается из пула.
         
+        Если задан on_job_complete, он вызывается в вызывающем потоке как
+        on_job_complete(job, results) сразу после последнего батча задания, а
+        результаты задания не хранятся. Возвращает {job_id: {start_row: результат}}
+        для остальных заданий.
+        """
+        batch_queue = []
+        for job_index, job in enumerate(jobs):
+            priority = job.get('priority', 0)
+            for batch_index, batch_data in enumerate(job['batches']):
+                heapq.heappush(batch_queue, (-priority, batch_index, job_index, (),
+                                             job['job_id'], batch_data))
+        
+        self.total_batches = len(batch_queue)
+        self.completed_batches = 0
+        results = {job['job_id']: {} for job in jobs}
+        remaining = {job['job_id']: len(job['batches']) for job in jobs}
+        jobs_by_id = {job['job_id']: job for job in jobs}
+        completed_jobs = queue.Queue()
+        
+        available_servers = self.ensure_available_servers()
         if not available_servers:
-            print("❌ Нет доступных серверов!")
             return {}
         
-        self.server_urls = available_servers
-        print(f"🌐 Используется {len(available_servers)} серверов")
+        in_flight = {server_url: 0 for server_url in available_servers}
+        failures = {server_url: 0 for server_url in available_servers}
         
-        results = {}
+        def batch_label(job_id, batch_data):
+            job_label = f"{job_id}: " if job_id is not None else ""
+            return f"{job_label}строки {batch_data['start_row']}-{batch_data['end_row']}"
         
-        # Распределение батчей
-        with ThreadPoolExecutor(max_workers=max_workers or len(available_servers)) as executor:
-            future_to_batch = {}
-            
-            for batch_data in batches_data:
-                server_url = self.get_next_server()
-                future = executor.submit(self.send_batch_to_server, batch_data, server_url)
-                future_to_batch[future] = batch_data['start_row']
-            
-            # Сбор результатов
-            for future in as_completed(future_to_batch):
-                start_row = future_to_batch[future]
-                try:
-                    result = future.result()
+        def finish_batch(job_id):
+            # Вызывается под self._lock
+            remaining[job_id] -= 1
+            if remaining[job_id] == 0 and on_job_complete is not None:
+                completed_jobs.put((job_id, results.pop(job_id)))
+        
+        def worker():
+            while True:
+                with self._lock:
+                    if not batch_queue:
+                        return
+                    if not in_flight:
+                        # Исправных серверов не осталось - оставшиеся батчи теряются
+                        while batch_queue:
+                            _, _, _, _, job_id, batch_data = heapq.heappop(batch_queue)
+                            print(f"❌ {batch_label(job_id, batch_data)}: нет доступных серверов")
+                            finish_batch(job_id)
+                        return
+                    entry = heapq.heappop(batch_queue)
+                    tried_servers, job_id, batch_data = entry[3:]
+                    # Повторную попытку по возможности отдаем другому серверу
+                    candidates = [url for url in in_flight if url not in tried_servers] or list(in_flight)
+                    server_url = min(candidates, key=in_flight.get)
+                    in_flight[server_url] += 1
+                
+
+                result = self.send_batch_to_server(batch_data, server_url, job_id)
+                
+                with self._lock:
+                    if server_url in in_flight:
+                        in_flight[server_url] -= 1
+                    
                     if result:
-                        results[start_row] = result[1]
-                except Exception as e:
-                    print(f"💥 Исключение для строк {start_row}: {e}")
+                        failures[server_url] = 0
+                        results[job_id][batch_data['start_row']] = result[1]
+                        finish_batch(job_id)
+                        continue
+                    
+                    failures[server_url] += 1
+                    if failures[server_url] >= self.MAX_CONSECUTIVE_FAILURES and server_url in in_flight:
+                        del in_flight[server_url]
+                        print(f"🚫 {server_url}: {failures[server_url]} ошибок подряд, сервер исключен из пула")
+                    
+                    tried_servers += (server_url,)
+                    if len(tried_servers) < self.MAX_BATCH_ATTEMPTS:
+                        heapq.heappush(batch_queue, entry[:3] + (tried_servers,) + entry[4:])
+                    else:
+                        print(f"❌ {batch_label(job_id, batch_data)}: не обработаны за {len(tried_servers)} попыток")
+                        finish_batch(job_id)
+        
+        try:
+            num_workers = max_workers or len(available_servers)
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(worker) for _ in range(num_workers)]
+                
+                # Готовые задания обрабатываются здесь, чтобы потоки серверов
+                # занимались только запросами
+                pending = set(futures)
+                while pending or not completed_jobs.empty():
+                    try:
+                        job_id, job_results = completed_jobs.get(timeout=0.1)
+                    except queue.Empty:
+                        pending = {future for future in pending if not future.done()}
+                        continue
+                    on_job_complete(jobs_by_id[job_id], job_results)
+                
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"💥 Исключение в рабочем потоке: {e}")
+        finally:
+            self._known_data_cache.clear()
+        
+        alive_servers = [server_url for server_url in available_servers if server_url in in_flight]
+        if alive_servers:
+            self.server_urls = alive_servers
+        else:
+            # Все серверы отказали - при следующем вызове проверим их заново
+            self.servers_checked = False
         
-        return results
\ No newline at end of file
+        return results
@@ -3,43 +3,87 @@ import json
 import numpy as np
 import rasterio
 from pathlib import Path
+import tempfile
 import time
 from batch_manager import BatchManager
 from polygon_utils import load_geojson_polygon, create_polygon_mask
 from shared import interpolation_core, data_generator
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Клиент для распределенной интерполяции осадков"
-    )
-    
-    parser.add_argument("--region-json", required=True, help="JSON файл с границами региона")
-    parser.add_argument("--output-tif", required=True, help="Путь для сохранения GeoTIFF")
-    parser.add_argument("--stations", type=int, default=80, help="Количество станций")
-    parser.add_argument("--resolution", type=float, default=0.01, help="Разрешение растра в градусах")
-    parser.add_argument("--power", type=float, default=2.0, help="Степень для IDW интерполяции")
-    parser.add_argument("--polygon-geojson", help="GeoJSON с ограничивающим полигоном")
-    parser.add_argument("--servers", nargs='+', required=True, 
-                       help="URL серверов, например: http://192.168.1.100:5000")
-    parser.add_argument("--batch-size", type=int, default=20, help="Количество строк в батче")
-    
-    args = parser.parse_args()
-    
-    print("🚀 КЛИЕНТ ДЛЯ РАСПРЕДЕЛЕННЫХ ВЫЧИСЛЕНИЙ")
-    print("=" * 50)
-    print(f"Серверы: {args.servers}")
-    print(f"Размер батча: {args.batch_size} строк")
+def load_region(region_json):
+    """Загружает границы региона из JSON файла"""
+    with open(region_json, 'r') as f:
+        return json.load(f)
+
+def create_batches(lons_grid, lats_grid, known_data, power, polygon_mask, batch_size):
+    """Нарезает сетку на батчи по строкам"""
+    height = lons_grid.shape[0]
+    batches = []
+    for start_row in range(0, height, batch_size):
+        end_row = min(start_row + batch_size, height)
+
+        batch_data = {
+            'start_row': start_row,
+            'end_row': end_row,
+            'lons_grid': lons_grid[start_row:end_row],
+            'lats_grid': lats_grid[start_row:end_row],
+            'known_data': known_data,
+            'power': power,
+            'polygon_mask': polygon_mask[start_row:end_row] if polygon_mask is not None else None
+        }
+        batches.append(batch_data)
+    return batches
+
+def assemble_results(results, height, width):
+    """Собирает результаты батчей в единый массив"""
+    result_array = np.full((height, width, 2), np.nan, dtype=np.float32)
+
+    successful_batches = 0
+    for start_row, batch_results in results.items():
+        if batch_results is not None:
+            batch_size = batch_results.shape[0]
+            result_array[start_row:start_row + batch_size] = batch_results
+            successful_batches += 1
+
+    return result_array, successful_batches
+
+def save_geotiff(result_array, output_tif, transform):
+    """Сохраняет результаты интерполяции в двухканальный GeoTIFF"""
+    height, width = result_array.shape[:2]
+    output_path = Path(output_tif)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 2,
+        'dtype': np.float32,
+        'crs': 'EPSG:4326',
+        'transform': transform,
+        'compress': 'lzw',
+        'nodata': np.nan
+    }
+
+    with rasterio.open(str(output_path), 'w', **profile) as dst:
+        dst.write(result_array[:, :, 0], 1)
+        dst.write(result_array[:, :, 1], 2)
+        dst.set_band_description(1, "Maximum precipitation")
+        dst.set_band_description(2, "Mean precipitation (non-zero)")
+
+    return output_path
+
+def run_single(args):
+    """Обрабатывает один регион и сохраняет один GeoTIFF"""
     start_time = time.time()
-    
+
     # Загрузка региона
     try:
-        with open(args.region_json, 'r') as f:
-            region_bounds = json.load(f)
+        region_bounds = load_region(args.region_json)
         print(f"✓ Регион загружен: {region_bounds['name']}")
     except Exception as e:
         print(f"✗ Ошибка загрузки региона: {e}")
         return
-    
+
     # Генерация данных
     csv_path = "massachusetts_precipitation_data.csv"
     try:
@@ -49,7 +93,7 @@ def main():
     except Exception as e:
         print(f"✗ Ошибка генерации данных: {e}")
         return
-    
+
     # Загрузка известных данных
     try:
         known_data = interpolation_core.load_known_data(csv_path)
@@ -57,7 +101,7 @@ def main():
     except Exception as e:
         print(f"✗ Ошибка загрузки данных станций: {e}")
         return
-    
+
     # Создание сетки
     try:
         lons_grid, lats_grid, transform = interpolation_core.create_grid(
@@ -68,7 +112,7 @@ def main():
     except Exception as e:
         print(f"✗ Ошибка создания сетки: {e}")
         return
-    
+
     # Загрузка полигона (если указан)
     polygon_mask = None
     if args.polygon_geojson:
@@ -81,85 +125,43 @@ def main():
         except Exception as e:
             print(f"✗ Ошибка загрузки полигона: {e}")
             return
-    
+
     # Создание батчей
     print("📦 Подготовка батчей...")
-    batches = []
-    for start_row in range(0, height, args.batch_size):
-        end_row = min(start_row + args.batch_size, height)
-        
-        batch_data = {
-            'start_row': start_row,
-            'end_row': end_row,
-            'lons_grid': lons_grid[start_row:end_row],
-            'lats_grid': lats_grid[start_row:end_row],
-            'known_data': known_data,
-            'power': args.power,
-            'polygon_mask': polygon_mask[start_row:end_row] if polygon_mask is not None else None
-        }
-        batches.append(batch_data)
-    
+    batches = create_batches(lons_grid, lats_grid, known_data, args.power,
+                             polygon_mask, args.batch_size)
     print(f"✓ Создано {len(batches)} батчей")
-    
+
     # Распределение батчей по серверам
     print("🌐 Распределение вычислений...")
     try:
         batch_manager = BatchManager(args.servers)
         results = batch_manager.distribute_batches(batches, max_workers=len(args.servers))
-        
+
         if not results:
             print("✗ Не получено ни одного результата от серверов")
             return
-            
+
         print(f"✓ Получено результатов: {len(results)}/{len(batches)} батчей")
-        
+
     except Exception as e:
         print(f"✗ Ошибка распределения батчей: {e}")
         return
-    
+
     # Сбор результатов
     print("🔄 Сбор результатов...")
-    result_array = np.full((height, width, 2), np.nan, dtype=np.float32)
-    
-    successful_batches = 0
-    for start_row, batch_results in results.items():
-        if batch_results is not None:
-            batch_size = batch_results.shape[0]
-            result_array[start_row:start_row + batch_size] = batch_results
-            successful_batches += 1
-    
+    result_array, successful_batches = assemble_results(results, height, width)
     print(f"✓ Собрано {successful_batches} батчей")
-    
+
     # Сохранение результатов
     print("💾 Сохранение результатов...")
     try:
-        output_path = Path(args.output_tif)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        profile = {
-            'driver': 'GTiff',
-            'height': height,
-            'width': width,
-            'count': 2,
-            'dtype': np.float32,
-            'crs': 'EPSG:4326',
-            'transform': transform,
-            'compress': 'lzw',
-            'nodata': np.nan
-        }
-        
-        with rasterio.open(str(output_path), 'w', **profile) as dst:
-            dst.write(result_array[:, :, 0], 1)
-            dst.write(result_array[:, :, 1], 2)
-            dst.set_band_description(1, "Maximum precipitation")
-            dst.set_band_description(2, "Mean precipitation (non-zero)")
-        
+        output_path = save_geotiff(result_array, args.output_tif, transform)
         print(f"✓ Результаты сохранены: {output_path}")
-        
     except Exception as e:
         print(f"✗ Ошибка сохранения: {e}")
         return
-    
+
     # Статистика выполнения
     total_time = time.time() - start_time
     print("=" * 50)
@@ -168,5 +170,200 @@ def main():
     print(f"📊 Успешных батчей: {successful_batches}/{len(batches)}")
     print(f"🌐 Использовано серверов: {len(args.servers)}")
 
+def load_jobs_manifest(jobs_json, args):
+    """
+    Загружает манифест заданий.
+
+    Манифест - JSON список заданий или объект {"jobs": [...]}. Каждое задание
+    обязано содержать 'region_json' и 'output_tif' и может переопределять
+    'name', 'polygon_geojson', 'stations', 'resolution', 'power' и 'priority';
+    отсутствующие параметры берутся из аргументов командной строки. Имя задания
+    по умолчанию - путь 'output_tif'; имена и выходные файлы не должны повторяться.
+    """
+    with open(jobs_json, 'r') as f:
+        manifest = json.load(f)
+
+    if isinstance(manifest, dict):
+        manifest = manifest['jobs']
+
+    jobs = []
+    names = set()
+    output_paths = set()
+    for index, job in enumerate(manifest):
+        for key in ('region_json', 'output_tif'):
+            if key not in job:
+                raise ValueError(f"задание #{index} не содержит '{key}'")
+        name = job.get('name', job['output_tif'])
+        if name in names:
+            raise ValueError(f"повторяющееся имя задания '{name}'")
+        names.add(name)
+        output_path = Path(job['output_tif']).resolve()
+        if output_path in output_paths:
+            raise ValueError(f"задание '{name}': файл '{job['output_tif']}' уже используется другим заданием")
+        output_paths.add(output_path)
+        jobs.append({
+            'name': name,
+            'region_json': job['region_json'],
+            'output_tif': job['output_tif'],
+            'polygon_geojson': job.get('polygon_geojson', args.polygon_geojson),
+            'stations': int(job.get('stations', args.stations)),
+            'resolution': float(job.get('resolution', args.resolution)),
+            'power': float(job.get('power', args.power)),
+            'priority': int(job.get('priority', 0))
+        })
+    return jobs
+
+def run_jobs(args):
+    """
+    Обрабатывает манифест заданий через один общий пул серверов.
+
+    Данные станций, сетки и маски полигонов загружаются один раз на уникальный
+    набор параметров и разделяются между заданиями, а батчи всех заданий идут
+    через одну очередь BatchManager с учетом приоритетов. Каждый GeoTIFF
+    сохраняется сразу после завершения последнего батча своего задания.
+    """
+    start_time = time.time()
+
+    try:
+        jobs = load_jobs_manifest(args.jobs_json, args)
+        print(f"✓ Загружено заданий: {len(jobs)}")
+    except Exception as e:
+        print(f"✗ Ошибка загрузки манифеста заданий: {e}")
+        return
+
+    regions = {}
+    station_data = {}
+    grids = {}
+    polygons = {}
+    polygon_masks = {}
+    prepared = []
+    completed_jobs = []
+
+    def save_job(job, job_results):
+        height, width = job['shape']
+        result_array, successful_batches = assemble_results(job_results, height, width)
+        if successful_batches == 0:
+            print(f"✗ {job['job_id']}: не получено ни одного результата")
+            return
+        try:
+            output_path = save_geotiff(result_array, job['output_tif'], job['transform'])
+            print(f"💾 {job['job_id']}: {successful_batches}/{job['num_batches']} батчей, сохранено в {output_path}")
+            completed_jobs.append(job['job_id'])
+        except Exception as e:
+            print(f"✗ {job['job_id']}: ошибка сохранения: {e}")
+
+    # Временные CSV станций живут до конца распределения батчей
+    with tempfile.TemporaryDirectory() as data_dir:
+        print("📦 Подготовка заданий...")
+        for job in jobs:
+            try:
+                if job['region_json'] not in regions:
+                    regions[job['region_json']] = load_region(job['region_json'])
+                region_bounds = regions[job['region_json']]
+                bounds_key = tuple(region_bounds[k] for k in ('west', 'east', 'south', 'north'))
+
+                # Станции зависят только от границ региона и их количества
+                stations_key = bounds_key + (job['stations'],)
+                if stations_key not in station_data:
+                    csv_path = str(Path(data_dir) / f"precipitation_data_{len(station_data)}.csv")
+                    data_generator.generate_precipitation_data(region_bounds, job['stations'], csv_path)
+                    station_data[stations_key] = interpolation_core.load_known_data(csv_path)
+                known_data = station_data[stations_key]
+
+                grid_key = bounds_key + (job['resolution'],)
+                if grid_key not in grids:
+                    grids[grid_key] = interpolation_core.create_grid(region_bounds, job['resolution'])
+                lons_grid, lats_grid, transform = grids[grid_key]
+                height, width = lons_grid.shape
+
+                polygon_mask = None
+                if job['polygon_geojson']:
+                    mask_key = (job['polygon_geojson'], grid_key)
+                    if mask_key not in polygon_masks:
+                        if job['polygon_geojson'] not in polygons:
+                            polygons[job['polygon_geojson']] = load_geojson_polygon(job['polygon_geojson'])
+                        polygon_masks[mask_key] = create_polygon_mask(polygons[job['polygon_geojson']],
+                                                                      transform, width, height)
+                    polygon_mask = polygon_masks[mask_key]
+
+                batches = create_batches(lons_grid, lats_grid, known_data, job['power'],
+                                         polygon_mask, args.batch_size)
+            except Exception as e:
+                print(f"✗ {job['name']}: ошибка подготовки задания: {e}")
+                continue
+
+            print(f"✓ {job['name']}: {region_bounds['name']}, сетка {height} x {width}, "
+                  f"{len(batches)} батчей, приоритет {job['priority']}")
+            prepared.append({
+                'job_id': job['name'],
+                'priority': job['priority'],
+                'batches': batches,
+                'num_batches': len(batches),
+                'output_tif': job['output_tif'],
+                'transform': transform,
+                'shape': (height, width)
+            })
+
+        if not prepared:
+            print("✗ Нет заданий для обработки")
+            return
+
+        print(f"✓ Станционных наборов: {len(station_data)}, сеток: {len(grids)}")
+
+        # Распределение батчей всех заданий по общему пулу серверов,
+        # результаты сохраняются по мере завершения заданий
+        print("🌐 Распределение вычислений...")
+        try:
+            batch_manager = BatchManager(args.servers)
+            batch_manager.distribute_jobs(prepared, max_workers=len(args.servers),
+                                          on_job_complete=save_job)
+        except Exception as e:
+            print(f"✗ Ошибка распределения батчей: {e}")
+            return
+
+    if not completed_jobs:
+        print("✗ Не получено ни одного результата от серверов")
+        return
+
+    # Статистика выполнения
+    total_time = time.time() - start_time
+    print("=" * 50)
+    print("✅ ВЫЧИСЛЕНИЯ ЗАВЕРШЕНЫ!")
+    print(f"⏱️  Общее время: {total_time:.1f} секунд")
+    print(f"📊 Успешных заданий: {len(completed_jobs)}/{len(jobs)}")
+    print(f"🌐 Использовано серверов: {len(batch_manager.server_urls)}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Клиент для распределенной интерполяции осадков"
+    )
+
+    parser.add_argument("--region-json", help="JSON файл с границами региона")
+    parser.add_argument("--output-tif", help="Путь для сохранения GeoTIFF")
+    parser.add_argument("--jobs-json",
+                       help="JSON манифест с несколькими заданиями (вместо --region-json/--output-tif)")
+    parser.add_argument("--stations", type=int, default=80, help="Количество станций")
+    parser.add_argument("--resolution", type=float, default=0.01, help="Разрешение растра в градусах")
+    parser.add_argument("--power", type=float, default=2.0, help="Степень для IDW интерполяции")
+    parser.add_argument("--polygon-geojson", help="GeoJSON с ограничивающим полигоном")
+    parser.add_argument("--servers", nargs='+', required=True,
+                       help="URL серверов, например: http://192.168.1.100:5000")
+    parser.add_argument("--batch-size", type=int, default=20, help="Количество строк в батче")
+
+    args = parser.parse_args()
+
+    if not args.jobs_json and not (args.region_json and args.output_tif):
+        parser.error("требуется --jobs-json или пара --region-json и --output-tif")
+
+    print("🚀 КЛИЕНТ ДЛЯ РАСПРЕДЕЛЕННЫХ ВЫЧИСЛЕНИЙ")
+    print("=" * 50)
+    print(f"Серверы: {args.servers}")
+    print(f"Размер батча: {args.batch_size} строк")
+
+    if args.jobs_json:
+        run_jobs(args)
+    else:
+        run_single(args)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()